@@ -16,8 +16,161 @@ __version__ = "0.0.1"
 __email__ = "wdchromium@gmail.com"
 
 import os
+import re
+import mmap
 import subprocess
-import shlex
+import mailbox
+import tempfile
+import tarfile
+from getpass import getuser
+from email import message_from_bytes
+from email.parser import BytesHeaderParser
+from collections import deque
+
+try: # optional: SIMD base64 decoding for attachments
+    import pybase64
+except ImportError:
+    pybase64 = None
+
+# directory holding this script; commit.tar is written here
+SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
+
+# separator line that starts each message in an mbox file
+MBOX_FROM_LINE = re.compile(rb'^From ', re.MULTILINE)
+
+def mbox_spans(mm):
+    """ Yields (from_line, start, stop) offsets for each message of an
+        mbox held in a mmap (or bytes): where its 'From ' line begins,
+        where the message after it begins, and where the message ends.
+    """
+    matches = MBOX_FROM_LINE.finditer(mm)
+    match = next(matches, None)
+    while match:
+        next_match = next(matches, None)
+        stop = next_match.start() if next_match else len(mm)
+        eol = mm.find(b'\n', match.start(), stop)
+        start = eol + 1 if eol >= 0 else stop
+        # like mailbox, the blank line before the next
+        # 'From ' belongs to the separator, not the message
+        if stop - start >= 1 and mm[stop - 2:stop] == b'\n\n':
+            stop -= 1
+        yield (match.start(), start, stop)
+        match = next_match
+
+# tables of contents already built this process, by (path, st_dev,
+# st_ino) of the mbox, each with the (st_size, st_mtime_ns, st_ctime_ns)
+# it was built from; ctime cannot be set back, so a rewritten or reused
+# inode never matches. Only the MBOX_TOC_CACHE_SIZE latest are kept
+MBOX_TOC_CACHE = {}
+MBOX_TOC_CACHE_SIZE = 8
+
+class mmap_mbox(mailbox.mbox):
+    """ mailbox.mbox whose table of contents is built by one regex pass
+        over an mmap of the file, instead of reading it line by line
+        in Python; the offsets are the same. Reopening an unchanged
+        mbox in the same process reuses the table instead of rescanning.
+    """
+    def _generate_toc(self):
+        self._file.flush()
+        st = os.fstat(self._file.fileno())
+        self._file_length = st.st_size
+        key = (self._path, st.st_dev, st.st_ino)
+        stamp = (st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+        cached = MBOX_TOC_CACHE.pop(key, None)
+        if cached is None or cached[0] != stamp:
+            toc = {}
+            if self._file_length: # mmap refuses empty files
+                with mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    toc = dict(enumerate((from_line, stop)
+                                         for from_line, _, stop in mbox_spans(mm)))
+            cached = (stamp, toc)
+        # (re)inserted last, so the first entry is the least recently used
+        MBOX_TOC_CACHE[key] = cached
+        while len(MBOX_TOC_CACHE) > MBOX_TOC_CACHE_SIZE:
+            del MBOX_TOC_CACHE[next(iter(MBOX_TOC_CACHE))]
+        self._toc = dict(cached[1])
+        self._next_key = len(self._toc)
+
+def decode_payload(part):
+    """ Returns the transfer-decoded bytes of a leaf part. base64 is
+        handed to pybase64 when it is installed; anything it rejects,
+        and every other encoding, is left to the email package.
+    """
+    if pybase64 and part.get('content-transfer-encoding', '').strip().lower() == 'base64':
+        try:
+            return pybase64.b64decode(part.get_payload(), validate=False)
+        except ValueError: # binascii.Error, or non-ascii payload
+            pass
+    return part.get_payload(decode=True)
+
+def extract_parts(email, workdir):
+    """ Splits one parsed email into its body and attachment parts, each
+        written to a mkstemp file in workdir. Lives outside mbox_to_git
+        so that worker processes can run it.
+        Returns (subject, [(path, final_filename, size), ...]).
+    """
+    def fill_file(message_bytes):
+        """ Receives already-decoded bytes and writes them to "temporary" file.
+            Returns path and size of resultant file.
+        """
+        # create file directly in workdir, does not unlink
+        t_filedesc, t_filepath = tempfile.mkstemp(prefix='', dir=workdir)
+        # write through the descriptor mkstemp already opened; os.write
+        # may stop short, and slicing a memoryview resumes without a copy
+        view = memoryview(message_bytes)
+        while view:
+            view = view[os.write(t_filedesc, view):]
+        os.close(t_filedesc)
+
+        return (t_filepath, len(message_bytes))
+
+    processed_parts = []
+    subject = email.get('subject')
+    counter = { 'major': 0, 'minor': 0 }
+
+    # walk() visits every nested part; only leaves carry content
+    for e in email.walk():
+        if not e.is_multipart():
+            prescribed_filename = e.get_filename()
+            if prescribed_filename:
+                final_filename = prescribed_filename
+            else: # each time a non-prescribed_filename shows up, increment counter
+                if not counter['major'] and not counter['minor']:
+                    # but for first body of each email, give it the less-noisy name
+                    # considered chr(ord()) but it will break with bad characters
+                    # after ord('a') + 26
+                    final_filename = 'body'
+                else:
+                    final_filename = 'body_%s_%i' % (str(counter['major']).zfill(2), counter['minor'])
+                counter['minor'] += 1
+                counter['major'] += 1
+
+            tmp_filepath, tmp_size = fill_file(decode_payload(e))
+            processed_parts.append( (tmp_filepath, final_filename, tmp_size) )
+        else:
+            # ignore processing multipart containers (and message/rfc822)
+            # because their parts are already going to be processed with walk
+            counter['minor'] = 0
+
+    return (subject, processed_parts)
+
+def extract_raw_email(raw_email, workdir):
+    """ extract_parts() for the raw bytes of an email as yielded by
+        mbox_to_git.iter_raw_messages(); picklable for process pools.
+    """
+    return extract_parts(message_from_bytes(raw_email), workdir)
+
+def bounded_map(executor, fn, iterable, *args, depth=16):
+    """ Ordered executor.map() which keeps at most depth tasks in flight,
+        so a large mbox is never queued into memory all at once.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item, *args))
+        if len(pending) >= depth:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
 
 class Decorators(object):
     def check_clean_before(func):
@@ -33,17 +186,42 @@ class Decorators(object):
             return retval
         return decorated
 
-class mbox_to_git(object):
-    def __init__(self, mbox_path, repodir="mboxrepo"):
-        import mailbox
+    def sync_before(func):
+        def decorated(self, *args, **kwargs):
+            self.sync_repo()
+            return func(self, *args, **kwargs)
+        return decorated
 
+class mbox_to_git(object):
+    def __init__(self, mbox_path, repodir="mboxrepo", verify_clean=False):
         self.mbox_fp = mbox_path
         self.repodir = repodir
+        # debugging aid: have every clean check walk the tree with git
+        self.verify_clean = verify_clean
         self.mailbox = None
-        self.messages = []
+        self.messages = None
+        self.importer = None
+        self.import_mark = 0
+        # HEAD and commit count as last known; None means ask git
+        self.known_head = None
+        self.known_count = None
+        # (commit id, summary lines) of the last commit this object made
+        self.last_summary = None
+        # answers of history queries, valid only for HEAD query_head;
+        # emptied as soon as HEAD moves, so it never outgrows one HEAD
+        self.query_cache = {}
+        self.query_head = None
+        # .gitignore of an encrypted repo, opened once on first secret commit
+        self.gitignore = None
+        # False once everything this object wrote is committed, True while
+        # parts in pending_parts are not, None when unknown (ask git)
+        self.dirty = None
+        # paths of the parts written by process_email/adopt_parts and not
+        # committed yet; only these can have left the tree dirty
+        self.pending_parts = set()
 
         try:
-            self.mailbox = mailbox.mbox(mbox_path)
+            self.mailbox = mmap_mbox(mbox_path)
         except IsADirectoryError:
             raise RuntimeError("provided path is not an mbox file")
         except AttributeError:
@@ -52,27 +230,71 @@ class mbox_to_git(object):
             # put a lock on the mailbox preventing external edits
             # until this object is closed / full script execution
             self.mailbox.lock()
-            # emails from mbox_path are IMMEDIATELY read and copied
-            # to this object; this makes it potentially one of the
-            # longest calls and least protected from untesetd email
+            # emails are NOT read up front; the mailbox is iterable and
+            # indexable by key (0..n-1) and only parses a message from
+            # its file offset on access, so at most one message is resident
             # TODO: find email structure that mailbox obj raises for
-            self.messages = [msg for msg in self.mailbox]
+            self.messages = self.mailbox
 
     def __enter__(self):
         return self # boilerplate for allowing with/as context mgr
 
     def __exit__(self, type, value, traceback):
-        self.mailbox.unlock()
-        self.mailbox.close()
+        if self.gitignore:
+            self.gitignore.close()
+        try:
+            self.sync_repo()
+        except RuntimeError:
+            # an exception already leaving the with block is the one to
+            # report; a git failure only surfaces when there is none
+            if type is None: raise
+        finally:
+            # never leave the mbox locked, even if git failed
+            self.mailbox.unlock()
+            self.mailbox.close()
+
+    def iter_raw_messages(self, limit=None):
+        """ Yields the raw bytes of each message in the mbox, without its
+            'From ' line, matching mailbox.get_bytes(). Boundaries are found
+            by a regex over an mmap of the file instead of mailbox's line
+            by line table of contents, and only the current message is
+            ever copied out; parse it with email.message_from_bytes().
+            With limit, at most that many leading bytes of each are copied.
+        """
+        with open(self.mbox_fp, 'rb') as fh:
+            if not os.fstat(fh.fileno()).st_size:
+                return # mmap refuses empty files
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for _, start, stop in mbox_spans(mm):
+                    if limit is not None:
+                        stop = min(stop, start + limit)
+                    yield mm[start:stop]
+
+    def iter_messages(self):
+        """ Yields each email in the mbox, fully parsed, one at a time;
+            only the message being looked at is ever held in memory.
+        """
+        for raw_email in self.iter_raw_messages():
+            yield message_from_bytes(raw_email)
+
+    def iter_headers(self, window=8192):
+        """ Yields a Message per email holding only its headers, for passes
+            (indexing, date filtering) that never look at bodies. Only the
+            first window bytes of each message are read and no MIME
+            structure is parsed.
+        """
+        parser = BytesHeaderParser()
+        for raw_headers in self.iter_raw_messages(limit=window):
+            yield parser.parsebytes(raw_headers)
 
     def clear_inbox(self):
         self.mailbox.clear()
         self.mailbox.flush()
 
+    @Decorators.sync_before
     @Decorators.check_clean_after
     def init_repo(self,
                   encrypted=False):
-        commands = ['git init --initial-branch="main"']
         try:
             os.mkdir(self.repodir)
         except FileExistsError:
@@ -82,25 +304,27 @@ class mbox_to_git(object):
             else:
                 raise FileExistsError("Cannot re-init a repo.")
 
-        for c in commands:
-            subprocess.call(shlex.split(c),
-                            cwd=self.repodir,
-                            stdout=subprocess.DEVNULL)
-
+        subprocess.run(['git', 'init', '--initial-branch=main'],
+                       cwd=self.repodir,
+                       stdout=subprocess.DEVNULL)
         # TODO: this will also need to eventually accept user input
-        from getpass import getuser
         self.set_user(getuser(), "%s@local" % getuser())
 
         if encrypted:
-            commands = [ 'git secret init',
-                         'git add .',
-                         'git commit -m "initializing git-secret module"' ]
+            commands = [ ['git', 'secret', 'init'],
+                         ['git', 'add', '.'],
+                         ['git', 'commit', '-m', 'initializing git-secret module'] ]
 
-        for c in commands:
-            subprocess.call(shlex.split(c),
-                            cwd=self.repodir,
-                            stdout=subprocess.DEVNULL)
+            # argv directly, no shell in between; stop at the first failure
+            for c in commands:
+                if subprocess.run(c,
+                                  cwd=self.repodir,
+                                  stdout=subprocess.DEVNULL).returncode:
+                    break
+        self.forget_head()
+        self.dirty = None
 
+    @Decorators.sync_before
     @Decorators.check_clean_before
     @Decorators.check_clean_after
     def tell_secret(self, email):
@@ -109,28 +333,31 @@ class mbox_to_git(object):
             this means possession of pubkey imported into GPG.
         """
         # TODO: accept filepath to a key or potentially generate
-        commands = [ 'git secret tell %s' % email,
-                     'git add .',
-                     'git commit -m "adding %s gpg identity"' % email ]
+        commands = [ ['git', 'secret', 'tell', email],
+                     ['git', 'add', '.'],
+                     ['git', 'commit', '-m', 'adding %s gpg identity' % email] ]
 
         for c in commands:
-            subprocess.run(shlex.split(c),
+            subprocess.run(c,
                            cwd=self.repodir,
                            stdout=subprocess.DEVNULL,
                            stderr=subprocess.DEVNULL)
+        self.forget_head()
+        self.dirty = None
 
+    @Decorators.sync_before
     def set_user(self, user, email):
         """ Accepts user and email from user and sets in git as author.
             No functionality will work if this doesn't satisfy git.
         """
-        # TODO: Protected from injection via shlex, but otherwise could
-        #       greatly benefit from sanitization and bad input detection
-        commands = [ 'git config user.name "%s"' % user,
-                     'git config user.email "%s"' % email ]
-
-        for c in commands:
-            subprocess.run(shlex.split(c),
-                           cwd=self.repodir)
+        # TODO: could greatly benefit from sanitization and bad input detection
+        # git config does the parsing, quoting and locking of .git/config;
+        # argv directly, no shell in between. --replace-all leaves a single
+        # value even where the key was set more than once
+        for key, value in (('user.name', user), ('user.email', email)):
+            if subprocess.run(['git', 'config', '--replace-all', key, value],
+                              cwd=self.repodir).returncode:
+                raise RuntimeError('git config %s failed; cannot continue' % key)
 
     @Decorators.check_clean_before
     def process_email(self, email):
@@ -138,76 +365,48 @@ class mbox_to_git(object):
             Identifies multipart emails and splits body and attachments
             all into separate files implemented with mkstemp.
         """
-        def fill_file(data, encoding):
-            """ Receives data BASE64/ASCII and writes it to "temporary" file.
-                Returns filedescriptor, path, and size of resultant file.
-            """
-            if encoding == 'base64':
-                import base64
-                ascii_as_bytes = data.encode('ascii')
-                message_bytes = base64.b64decode(ascii_as_bytes)
-            else: # ['8bit','ascii','quoted-printable']
-                ascii_as_bytes = data.encode('utf-8')
-                message_bytes = ascii_as_bytes
-
-            import tempfile
-            # create file directly in repopath, does not unlink
-            t_filedesc, t_filepath = tempfile.mkstemp(prefix='', dir=self.repodir)
-            open_file = open(t_filepath, 'w+b')
-            open_file.write(message_bytes)
-            open_file.flush()
-            open_file.close()
-
-            return (t_filedesc, t_filepath, len(message_bytes))
-
-        processed_parts = []
-        subject = email.get('subject')
-        counter = { 'major': 0, 'minor': 0 }
-
-        for e in email.walk():
-            payload = e.get_payload()
-            if not isinstance(payload, list):
-                prescribed_filename = e.get_filename()
-                if prescribed_filename:
-                    final_filename = prescribed_filename
-                else: # each time a non-prescribed_filename shows up, increment counter
-                    if not counter['major'] and not counter['minor']:
-                        # but for first body of each email, give it the less-noisy name
-                        # considered chr(ord()) but it will break with bad characters
-                        # after ord('a') + 26
-                        final_filename = 'body'
-                    else:
-                        final_filename = 'body_%s_%i' % (str(counter['major']).zfill(2), counter['minor'])
-                    counter['minor'] += 1
-                    counter['major'] += 1
-
-                encoding = e.get('Content-Transfer-Encoding')
-                tmp_filedesc, tmp_filepath, tmp_size = fill_file(payload, encoding)
-                processed_parts.append( (tmp_filepath, final_filename, tmp_size) )
-            else:
-                # ignore processing mboxMessages that contain lists because
-                # they are already going to be processed with walk, anyway
-                counter['minor'] = 0
-
+        subject, processed_parts = extract_parts(email, self.repodir)
+        if processed_parts: self.dirty = True
+        self.pending_parts.update(fp for fp, _, _ in processed_parts)
         return (subject, processed_parts)
 
-    @Decorators.check_clean_after
+    @Decorators.check_clean_before
+    def adopt_parts(self, processed_parts):
+        """ Moves parts extracted outside the working tree, e.g. by worker
+            processes, into it under fresh mkstemp names. Returns the
+            parts as process_email would have.
+        """
+        adopted = []
+        for staged_path, final_name, size in processed_parts:
+            t_filedesc, t_filepath = tempfile.mkstemp(prefix='', dir=self.repodir)
+            os.close(t_filedesc)
+            os.replace(staged_path, t_filepath)
+            adopted.append( (t_filepath, final_name, size) )
+        if adopted: self.dirty = True
+        self.pending_parts.update(fp for fp, _, _ in adopted)
+        return adopted
+
+    @staticmethod
+    def create_summary(processed_parts):
+        """ Returns the name of each processed part within the repo and the
+            matching 'name:original_name:size' lines for the commit message
+        """
+        names = [os.path.basename(fp) for fp, _, _ in processed_parts]
+        summary = ["%s:%s:%i" % (name, final_name, fsize)
+                   for name, (_, final_name, fsize) in zip(names, processed_parts)]
+        return (names, summary)
+
+    # neither commit method checks clean afterwards: the stream is not
+    # synced, so git cannot tell yet, and pending_parts would only echo
+    # the parts just passed in; clean(force_refresh=True) asks git
     def make_commit(self, subject, processed_parts):
         """ Receives subject name and processed message parts and commits it to git log """
-        summary = []
-        for fp, final_name, fsize in processed_parts:
-            summary.append("%s:%s:%i" % (os.path.basename(fp), final_name, fsize))
-
-        commands = [ 'git add .',
-                     'git commit -m "%s" -m "%s"' % (subject, '\n'.join(summary)) ]
+        paths, summary = self.create_summary(processed_parts)
+        commit_id = self.import_commit(subject, summary, paths)
+        self.pending_parts.difference_update(fp for fp, _, _ in processed_parts)
+        self.dirty = bool(self.pending_parts)
+        return commit_id
 
-        for c in commands:
-            subprocess.run(shlex.split(c),
-                           cwd=self.repodir,
-                           stdout=subprocess.DEVNULL)
-        return self.head_id
-
-    @Decorators.check_clean_after
     def make_secret_commit(self, subject, processed_parts):
         """ Creates a new commit in the git tree including
             all attachments, the body text uploaded as 'body',
@@ -218,158 +417,346 @@ class mbox_to_git(object):
             a private key would be required to decrypt the key
             even after attaining the file.
         """
-        git_secret_add_cmds = []
-        git_add_cmds = ['git add .gitignore', 'git add .gitsecret/paths/mapping.cfg']
+        paths = ['.gitignore', os.path.join('.gitsecret', 'paths', 'mapping.cfg')]
         revised_summary = []
 
-        summary = []
-        for fp, final_name, fsize in processed_parts:
-            summary.append("%s:%s:%i" % (os.path.basename(fp), final_name, fsize))
-
-        with open(os.path.join(self.repodir, '.gitignore'), 'a') as gi:
-            for s in summary:
-                rnd_name = s.split(':')[0]
-                # git secret add does two things:
-                # 1) encrypts FILE and produces FILE.secret
-                git_secret_add_cmds.append("git secret add %s" % rnd_name)
-                # 2) requires FILE to be added to .gitignore
-                gi.write("%s\n" % rnd_name)
-
-                # git add the encrypted file with added suffix
-                git_add_cmds.append("git add %s.secret" % rnd_name)
-                # ensure the git commit longform contains the fn update
-                revised_summary.append(s.replace(':', '.secret:', 1))
-
-        for cmd in git_secret_add_cmds:
-            subprocess.run(shlex.split(cmd),
+        rnd_names, summary = self.create_summary(processed_parts)
+
+        for rnd_name, s in zip(rnd_names, summary):
+            # commit the encrypted file with added suffix
+            paths.append("%s.secret" % rnd_name)
+            # ensure the git commit longform contains the fn update
+            revised_summary.append("%s.secret%s" % (rnd_name, s[len(rnd_name):]))
+
+        # git secret add does two things:
+        # 1) encrypts FILE and produces FILE.secret
+        # 2) requires FILE to be added to .gitignore, which stays open in
+        #    append mode for the whole run; flushed before git-secret reads it
+        if self.gitignore is None:
+            self.gitignore = open(os.path.join(self.repodir, '.gitignore'), 'a')
+        self.gitignore.write(''.join("%s\n" % rnd_name for rnd_name in rnd_names))
+        self.gitignore.flush()
+
+        # one invocation registers every file of this email
+        if rnd_names:
+            subprocess.run(['git', 'secret', 'add', *rnd_names],
                            cwd=self.repodir,
                            stdout=subprocess.DEVNULL)
 
         # -F required to do encryption of only newly added files, instead of all
-        subprocess.run(shlex.split('git secret hide -F -d'),
+        subprocess.run(['git', 'secret', 'hide', '-F', '-d'],
                        cwd=self.repodir,
                        stdout=subprocess.DEVNULL,
                        stderr=subprocess.DEVNULL)
 
-        for cmd in git_add_cmds:
-            subprocess.run(shlex.split(cmd),
-                           cwd=self.repodir,
-                           stdout=subprocess.DEVNULL)
+        commit_id = self.import_commit(subject, revised_summary, paths)
+        self.pending_parts.difference_update(fp for fp, _, _ in processed_parts)
+        self.dirty = bool(self.pending_parts)
+        return commit_id
 
-        cmd = 'git commit -m "%s" -m "%s"' % (subject,
-                                             '\n'.join(revised_summary))
-        subprocess.run(shlex.split(cmd),
-                       cwd=self.repodir,
-                       stdout=subprocess.DEVNULL)
+    def import_stream(self):
+        """ Returns the git fast-import process for this repo, starting
+            one on first use. Commits written to it are only visible to
+            other git commands after sync_repo() ends the stream.
+        """
+        if self.importer is None:
+            cmp_proc = subprocess.run(['git', 'var', 'GIT_COMMITTER_IDENT'],
+                                      cwd=self.repodir,
+                                      stdout=subprocess.PIPE,
+                                      text=True)
+            # drop the trailing timestamp and offset; fast-import is told 'now'
+            self.import_ident = cmp_proc.stdout.strip().rsplit(' ', 2)[0]
 
-        return self.head_id
+            cmp_proc = subprocess.run(['git', 'symbolic-ref', 'HEAD'],
+                                      cwd=self.repodir,
+                                      stdout=subprocess.PIPE,
+                                      text=True)
+            self.import_branch = cmp_proc.stdout.strip()
+            # first commit of each stream must name its parent explicitly,
+            # every later one continues from the branch held in fast-import
+            self.import_parent = self.head_id
+
+            self.importer = subprocess.Popen(['git', 'fast-import', '--quiet', '--date-format=now'],
+                                             cwd=self.repodir,
+                                             stdin=subprocess.PIPE,
+                                             stdout=subprocess.PIPE)
+        return self.importer
+
+    def import_commit(self, subject, summary, paths):
+        """ Writes the files at paths (relative to the repo) as blobs,
+            followed by a commit containing them, into the fast-import
+            stream. Each blob is read from the file as it is on disk now,
+            so the commit always matches the working tree. The message is passed as length-prefixed data, never
+            through argv or a shell. Returns the hash of the new commit.
+        """
+        importer = self.import_stream()
+        stream = importer.stdin
+
+        marks = []
+        for path in paths:
+            with open(os.path.join(self.repodir, path), 'rb') as fh:
+                data = fh.read()
+            self.import_mark += 1
+            stream.write(b'blob\nmark :%i\ndata %i\n' % (self.import_mark, len(data)))
+            stream.write(data)
+            stream.write(b'\n')
+            marks.append(self.import_mark)
+
+        self.import_mark += 1
+        # a folded (multi-line) Subject header is unfolded so the first line
+        # stays the subject and the summary lines keep their own paragraph
+        subject = ''.join(str(subject).splitlines())
+        message = ('%s\n\n%s\n' % (subject, '\n'.join(summary))).encode('utf-8')
+        header = 'commit %s\nmark :%i\ncommitter %s now\n' % (self.import_branch,
+                                                              self.import_mark,
+                                                              self.import_ident)
+        stream.write(header.encode('utf-8'))
+        stream.write(b'data %i\n' % len(message))
+        stream.write(message)
+        stream.write(b'\n')
+        if self.import_parent:
+            stream.write(b'from %s\n' % self.import_parent.encode('ascii'))
+            self.import_parent = None
+        for mark, path in zip(marks, paths):
+            stream.write(b'M 100644 :%i %s\n' % (mark, path.encode('utf-8')))
+        stream.write(b'\nget-mark :%i\n' % self.import_mark)
+        stream.flush()
+
+        commit_id = importer.stdout.readline().decode('ascii').strip()
+        if not commit_id: raise RuntimeError('git fast-import stopped responding; cannot continue')
+
+        self.known_head = commit_id
+        if self.known_count is not None:
+            self.known_count += 1
+        self.last_summary = (commit_id, summary)
+        return commit_id
+
+    def sync_repo(self):
+        """ Ends the fast-import stream, if any, so its commits land on
+            the branch, then resets the index to the new HEAD. The files
+            themselves are already in the working tree. Anything staged
+            outside of this object is unstaged by that reset.
+        """
+        if self.importer is None:
+            return
+
+        importer = self.importer
+        self.importer = None
+        importer.communicate()
+        if importer.returncode: raise RuntimeError('git fast-import failed; cannot continue')
+
+        if subprocess.run(['git', 'reset', '--quiet'],
+                          cwd=self.repodir,
+                          stdout=subprocess.DEVNULL).returncode:
+            raise RuntimeError('git reset failed; cannot continue')
+
+    def forget_head(self):
+        """ Drops the remembered HEAD and commit count; called after any
+            commit made outside of fast-import so git is asked again.
+            Callers that commit, reset or check out in the repo behind
+            this object's back must call it too.
+        """
+        self.known_head = None
+        self.known_count = None
 
     @property
     def head_id(self):
-        """ Returns commit hash of the current HEAD """
-        cmp_proc = subprocess.run(shlex.split('git rev-parse HEAD'),
-                                  cwd=self.repodir,
-                                  stdout=subprocess.PIPE,
-                                  stderr=subprocess.DEVNULL,
-                                  text=True)
-        if cmp_proc.returncode == 128:
-            return None # triggers on dir not yet git init-ed
-        else:
-            return cmp_proc.stdout.strip()
-
-    @property
-    def commit_count(self):
-        """ Returns number of commits in current branch """
-        try:
-            cmp_proc = subprocess.run(shlex.split('git rev-list --count HEAD'),
+        """ Returns commit hash of the current HEAD. Remembered once
+            known and kept current by this object's own commits; a
+            commit or reset made outside of it is not noticed until
+            forget_head() is called, and neither are the history
+            queries cached for that HEAD.
+        """
+        if self.known_head is None:
+            self.sync_repo()
+            cmp_proc = subprocess.run(['git', 'rev-parse', 'HEAD'],
                                       cwd=self.repodir,
                                       stdout=subprocess.PIPE,
                                       stderr=subprocess.DEVNULL,
                                       text=True)
-        except FileNotFoundError:
-            return 0
-        else:
-            return int(cmp_proc.stdout.strip()) if cmp_proc.stdout else 0
+            if cmp_proc.returncode == 128:
+                return None # triggers on dir not yet git init-ed
+            self.known_head = cmp_proc.stdout.strip()
+        return self.known_head
+
+    @property
+    def commit_count(self):
+        """ Returns number of commits in current branch. Remembered
+            like head_id, with the same limitation: only forget_head()
+            makes it look at commits made outside of this object.
+        """
+        if self.known_count is None:
+            self.sync_repo()
+            try:
+                cmp_proc = subprocess.run(['git', 'rev-list', '--count', 'HEAD'],
+                                          cwd=self.repodir,
+                                          stdout=subprocess.PIPE,
+                                          stderr=subprocess.DEVNULL,
+                                          text=True)
+            except FileNotFoundError:
+                return 0 # repodir not created yet; nothing to remember
+            self.known_count = int(cmp_proc.stdout.strip()) if cmp_proc.stdout else 0
+        return self.known_count
 
     @property
     def clean(self):
         """ Returns bool of whether working tree is clean """
-        cmp_proc = subprocess.run(shlex.split('git status --porcelain'),
+        return self.is_clean(force_refresh=self.verify_clean)
+
+    def is_clean(self, force_refresh=False):
+        """ Returns bool of whether working tree is clean. Files written
+            and committed by this object are tracked here, so the answer
+            comes without git: parts written since the last commit are
+            looked up on disk, as they may have been removed since. git
+            only walks the working tree when the state is unknown (e.g.
+            after init_repo) or when force_refresh is given, which also
+            ends the fast-import stream first.
+        """
+        if force_refresh or self.dirty is None:
+            # dirty is only unknown before this object commits anything or
+            # right after init_repo/tell_secret, which sync; no stream is
+            # open then, so git already sees every commit
+            if force_refresh: self.sync_repo()
+            # any output at all means dirty, so only the first byte is read
+            # and git stopped there; without optional locks it never holds
+            # index.lock, so stopping it early cannot leave one behind.
+            # (diff-index --quiet would miss untracked files, i.e. new parts)
+            command = ['git', '--no-optional-locks', 'status', '--porcelain']
+            with subprocess.Popen(command,
                                   cwd=self.repodir,
-                                  stdout=subprocess.PIPE,
-                                  text=True)
-        return not bool(cmp_proc.stdout)
-
+                                  stdout=subprocess.PIPE) as status_proc:
+                self.dirty = bool(status_proc.stdout.read(1))
+                status_proc.terminate()
+        elif self.dirty:
+            self.dirty = any(os.path.lexists(fp) for fp in self.pending_parts)
+        if not self.dirty:
+            self.pending_parts.clear()
+        return not self.dirty
+
+    def head_queries(self):
+        """ Returns query_cache, first emptying it if it was filled at
+            a HEAD other than the current one """
+        head = self.head_id
+        if head != self.query_head:
+            self.query_cache.clear()
+            self.query_head = head
+        return self.query_cache
+
+    @Decorators.sync_before
     def get_commit_of_file(self, fn):
         """ Traverses commits in reverse for first match of filename fn
             and returns commit hash
         """
-        cmp_proc = subprocess.run(shlex.split('git rev-list -1 HEAD %s' % fn),
-                                  cwd=self.repodir,
-                                  stdout=subprocess.PIPE,
-                                  text=True)
-        return cmp_proc.stdout.strip()
-
+        cache = self.head_queries()
+        key = ('commit_of_file', fn)
+        if key not in cache:
+            cmp_proc = subprocess.run(['git', 'rev-list', '-1', 'HEAD', fn],
+                                      cwd=self.repodir,
+                                      stdout=subprocess.PIPE,
+                                      text=True)
+            cache[key] = cmp_proc.stdout.strip()
+        return cache[key]
+
+    @Decorators.sync_before
+    def get_commits_of_files(self, fns):
+        """ Batch form of get_commit_of_file: walks history once and returns
+            a dict of filename to the newest commit touching it. Filenames
+            not found in history are left out.
+        """
+        wanted = set(fns)
+        found = {}
+        # a NUL can never appear in a path, so it marks the commit lines
+        command = ['git', 'log', '--name-only', '--format=%x00%H', 'HEAD']
+        with subprocess.Popen(command,
+                              cwd=self.repodir,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL,
+                              text=True) as log_proc:
+            for line in log_proc.stdout:
+                line = line.rstrip('\n')
+                if line.startswith('\0'):
+                    commit = line[1:]
+                elif line in wanted and line not in found:
+                    found[line] = commit
+                    if len(found) == len(wanted): break
+            # stop the walk early once every file is accounted for
+            log_proc.terminate()
+        return found
+
+    @Decorators.sync_before
     def get_commit_filelist(self, commit):
         """ Construct a list of all files relevant to given commit hash """
-        command = 'git show --no-commit-id --name-only -r %s' % commit
-        cmp_proc = subprocess.run(shlex.split(command),
-                                  cwd=self.repodir,
-                                  stdout=subprocess.PIPE,
-                                  text=True)
-        line_output = cmp_proc.stdout.split('\n')
-        
-        retval = []
-        for line in line_output:
-            split = line.split(' ')
-            # expecting a line 'commit ab324298798b ...'
-            if len(split[0])==6 and len(split[1])==40 and split[0]=='commit': break
-            retval.append(line)
-        return retval
-
-    def create_tarball(self):
+        # diff-tree lists only paths (no header or diff); --root lets the
+        # first commit list its files and -z keeps any filename intact
+        cache = self.head_queries()
+        key = ('commit_filelist', commit)
+        if key not in cache:
+            command = ['git', 'diff-tree', '--no-commit-id', '--name-only', '-r', '-z', '--root', commit]
+            cmp_proc = subprocess.run(command,
+                                      cwd=self.repodir,
+                                      stdout=subprocess.PIPE)
+            cache[key] = [os.fsdecode(fn) for fn in cmp_proc.stdout.split(b'\0')[:-1]]
+        return list(cache[key])
+
+    def create_tarball(self, tarball_fp=None):
         """ Create tarball containing files of only HEAD commit.
             Changing the head may be entirely unnecessary because
             all files are going to be named with mkstemp so there
-            is no collision in that space. """
-        command = "git show --no-commit-id --name-only -r %s" % self.head_id
-        cmp_proc = subprocess.run(shlex.split(command),
-                                  cwd=self.repodir,
-                                  stdout=subprocess.PIPE,
-                                  text=True)
-
-        files = []
-        # files are demarcated by 'commit abcdef1234...' line
-        for line in cmp_proc.stdout.split('\n'):
-            if line.startswith('commit '):
-                break
-            else:
-                files.append(line)
-
+            is no collision in that space. Written to tarball_fp,
+            by default commit.tar beside this script. """
         file_mapping = []
-        # iterate stdout again to catch summary mapping below commit info
-        # this allows us to return the human-expected name rather than the mkstep
-        for line in cmp_proc.stdout.split('\n'):
-            if line.count(':') == 2:
-                rnd, orig, size = line.split(':')
-                rnd = rnd.strip()
-                if rnd in files: # if this line matches a known-file identified above
-                    file_mapping.append( (rnd, orig) )
-
-        script_path=os.path.dirname(os.path.realpath(__file__))
-        # this file is created outside the repo tree, in the script path
-        tarball_fp=os.path.join(script_path, 'commit.tar')
-
-        import tarfile
-        tar = tarfile.open(tarball_fp, 'w')
-        for random_name, original_name in file_mapping:
-            added_filepath = os.path.join(self.repodir, random_name)
-            tar.add(added_filepath, arcname=original_name)
-        tar.close()
+        head = self.head_id
+        if self.last_summary and self.last_summary[0] == head:
+            # HEAD was committed by this object, so its summary mapping
+            # is already at hand and git need not be asked for it
+            for line in self.last_summary[1]:
+                rnd, rest = line.split(':', 1)
+                file_mapping.append( (rnd, rest.rsplit(':', 1)[0]) )
+        else:
+            # only git show needs the stream flushed; the files themselves
+            # are in the working tree either way
+            self.sync_repo()
+            command = ['git', 'show', '--no-commit-id', '--name-only', '-r', head]
+            cmp_proc = subprocess.run(command,
+                                      cwd=self.repodir,
+                                      stdout=subprocess.PIPE)
+
+            files = set()
+            in_files = True
+            # files are demarcated by 'commit abcdef1234...' line; the summary
+            # mapping below the commit info gives the human-expected name
+            # rather than the mkstemp one, so both come from a single pass
+            # output stays bytes; only the names kept are decoded
+            for line in cmp_proc.stdout.splitlines():
+                if in_files:
+                    if line.startswith(b'commit '):
+                        in_files = False
+                    else:
+                        files.add(line)
+                elif line.count(b':') == 2:
+                    rnd, orig, size = line.split(b':')
+                    rnd = rnd.strip()
+                    if rnd in files: # if this line matches a known-file identified above
+                        file_mapping.append( (os.fsdecode(rnd), os.fsdecode(orig)) )
+
+        if tarball_fp is None:
+            # this file is created outside the repo tree, in the script path
+            tarball_fp=os.path.join(SCRIPT_PATH, 'commit.tar')
+
+        # written as a stream, never seeking back; each header comes from
+        # an fstat of the already-open file rather than a separate lstat
+        # (sizes are not taken from the summary: .secret files differ)
+        with tarfile.open(tarball_fp, 'w|', bufsize=1 << 20) as tar:
+            for random_name, original_name in file_mapping:
+                added_filepath = os.path.join(self.repodir, random_name)
+                with open(added_filepath, 'rb') as fh:
+                    tar.addfile(tar.gettarinfo(arcname=original_name, fileobj=fh), fh)
         return tarball_fp
 
 if __name__ == '__main__':
     from argparse import ArgumentParser
+    from concurrent.futures import ProcessPoolExecutor
+    import shutil
 
     parser = ArgumentParser(description='mbox to git repo converter')
     parser.add_argument('-m',
@@ -380,8 +767,15 @@ if __name__ == '__main__':
                         dest='gpg_email',
                         default=None,
                         help='implement git secret via provided email address')
+    parser.add_argument('-j',
+                        dest='workers',
+                        type=int,
+                        default=os.cpu_count() or 1,
+                        help='number of processes decoding messages')
 
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error('-j must be at least 1')
 
     with mbox_to_git(args.mbox_file) as instance:
         try:
@@ -392,14 +786,27 @@ if __name__ == '__main__':
             if args.gpg_email:
                 instance.tell_secret(args.gpg_email)
 
-        for msg in instance.messages:
-            subject, files_produced = instance.process_email(msg)
-            if args.gpg_email:
-                commit_id = instance.make_secret_commit(subject, files_produced)
-            else:
-                commit_id = instance.make_commit(subject, files_produced)
+        # decoding and writing parts runs in worker processes, one message
+        # per task; they write under .git so the working tree stays clean,
+        # and this process moves each message's parts in, in mbox order,
+        # right before committing them (git itself stays single-writer)
+        staging = tempfile.mkdtemp(dir=os.path.join(instance.repodir, '.git'))
+        try:
+            with ProcessPoolExecutor(max_workers=args.workers) as pool:
+                for subject, staged_parts in bounded_map(pool,
+                                                         extract_raw_email,
+                                                         instance.iter_raw_messages(),
+                                                         staging,
+                                                         depth=4 * args.workers):
+                    files_produced = instance.adopt_parts(staged_parts)
+                    if args.gpg_email:
+                        commit_id = instance.make_secret_commit(subject, files_produced)
+                    else:
+                        commit_id = instance.make_commit(subject, files_produced)
 
-            print("%s: %s" % (commit_id, subject))
-            for path, fn, size in files_produced:
-                print("%s -> %s (%s)" % (os.path.basename(path), fn, size))
+                    print("%s: %s" % (commit_id, subject))
+                    for path, fn, size in files_produced:
+                        print("%s -> %s (%s)" % (os.path.basename(path), fn, size))
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
 
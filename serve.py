@@ -1,33 +1,36 @@
 #!/usr/bin/env python3
 
 import asyncio
+import socket
 
 async def run_cat():
-    import subprocess
-    import shlex
-
-    command = 'nc --send-only -4 -l -p 8888'
+    # equivalent of: nc --send-only -4 -l -p 8888 < commit.tar
+    address = ('0.0.0.0', 8888)
     filepath = 'commit.tar'
 
+    loop = asyncio.get_running_loop()
     with open(filepath, 'rb') as fh:
-        print('reading data...')
-        data = fh.read()
         print('opening filesocket...')
-        proc = subprocess.Popen(shlex.split(command),
-                                stdin=subprocess.PIPE)
-        try:
-            proc.communicate(input=data, timeout=60)
-            print('transmitting...')
-        except subprocess.TimeoutExpired:
-            proc.kill()
-        finally:
-            print('closing socket...')
-            proc.terminate()
-            print('exiting process.')
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind(address)
+            server.listen(1)
+            server.setblocking(False)
+            try:
+                conn, _ = await asyncio.wait_for(loop.sock_accept(server), timeout=60)
+                with conn:
+                    print('transmitting...')
+                    # sendfile(2): the kernel copies from the page cache
+                    # straight to the socket; the file is never read in here
+                    await asyncio.wait_for(loop.sock_sendfile(conn, fh), timeout=60)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                print('closing socket...')
+        print('exiting process.')
 
 async def main():
     await asyncio.gather(run_cat())
 
 if __name__ == '__main__':
     asyncio.run(main())
-
@@ -3,19 +3,84 @@
 import unittest
 import mailbox
 import shutil
+import tempfile
 import os
-from convert import mbox_to_git
+import re
+import subprocess
+import tarfile
+import base64
+from email import message_from_bytes
+from unittest import mock
+from getpass import getuser
+from convert import mbox_to_git, mmap_mbox, extract_raw_email, decode_payload
+from convert import MBOX_TOC_CACHE, MBOX_TOC_CACHE_SIZE
 
-MBOX_FP = 'mbox.sample'
-REPO_FP = 'mboxrepo'
 GPG_EMAIL = 'wdchromium@gmail.com'
+USER_KEY = re.compile(r'^\s*(name|email)\s*=\s*(.*?)\s*$', re.MULTILINE)
+
+# test repos live in memory-backed tmpfs where there is one, and git is
+# told not to fsync; these repos are thrown away after every test. Every
+# file a test writes is under this run's own REPO_ROOT, so concurrent
+# runs (e.g. one per xdist worker) never share a path. The paths are set
+# by setUpModule, so merely importing this module creates nothing
+REPO_ROOT = REPO_FP = TARBALL_FP = THROWAWAY_FP = None
+MBOX_FP = TORTURE_FP = None
+GIT_TEST_ENV = { 'GIT_CONFIG_COUNT': '1',
+                 'GIT_CONFIG_KEY_0': 'core.fsync',
+                 'GIT_CONFIG_VALUE_0': 'none' }
+
+def set_aside(path):
+    """ Moves a finished repo out of the way with one rename; it is
+        deleted together with the rest of REPO_ROOT after the run. """
+    if os.path.exists(path):
+        os.rename(path, os.path.join(tempfile.mkdtemp(dir=REPO_ROOT), 'trash'))
+
+def is_ustar(path):
+    """ Sniffs the ustar magic of the first header; create_tarball always
+        writes that format and the members are parsed in full afterwards """
+    with open(path, 'rb') as fh:
+        return fh.read(512)[257:262] == b'ustar'
+
+def setUpModule():
+    global REPO_ROOT, REPO_FP, TARBALL_FP, THROWAWAY_FP, MBOX_FP, TORTURE_FP
+    REPO_ROOT = tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    REPO_FP = os.path.join(REPO_ROOT, 'mboxrepo')
+    TARBALL_FP = os.path.join(REPO_ROOT, 'commit.tar')
+    THROWAWAY_FP = os.path.join(REPO_ROOT, 'mbox.throwaway')
+    # mbox_to_git locks its mbox, so each run reads its own copy of the fixtures
+    MBOX_FP = shutil.copy('mbox.sample', REPO_ROOT)
+    TORTURE_FP = shutil.copy('rf-mime-torture-test-1.0.mbox', REPO_ROOT)
+    os.environ.update(GIT_TEST_ENV)
+
+def tearDownModule():
+    for key in GIT_TEST_ENV:
+        os.environ.pop(key, None)
+    shutil.rmtree(REPO_ROOT, ignore_errors=True)
 
 class Testmbox_to_git(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # parsed once for the whole class; tests only read them
+        sample = mailbox.mbox(MBOX_FP)
+        cls.messages = list(sample)
+        sample.close()
+
+        # repos made once by init_repo(), copied in by init_from_template()
+        # for tests where initializing is not what is being tested
+        cls.template_root = tempfile.mkdtemp(dir=REPO_ROOT)
+        cls.addClassCleanup(shutil.rmtree, cls.template_root, ignore_errors=True)
+        cls.templates = {}
+        for encrypted in (False, True):
+            template = os.path.join(cls.template_root, 'encrypted' if encrypted else 'plain')
+            with mbox_to_git(MBOX_FP, repodir=template) as instance:
+                instance.init_repo(encrypted=encrypted)
+            cls.templates[encrypted] = template
+
+    def init_from_template(self, instance, encrypted=False):
+        shutil.copytree(self.templates[encrypted], instance.repodir, symlinks=True)
+
     def setUp(self):
-        try:
-            shutil.rmtree('mboxrepo')
-        except FileNotFoundError:
-            pass
+        set_aside(REPO_FP)
 
     def tearDown(self):
         pass
@@ -46,125 +111,281 @@ class Testmbox_to_git(unittest.TestCase):
     #            with mbox_to_git(MBOX_FP) as instance2:
     #                pass
 
+    def test_unlocks_mbox_when_git_fails(self):
+        with self.assertRaises(RuntimeError):
+            with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
+                self.init_from_template(instance)
+                instance.import_stream().stdin.write(b'not a fast-import command\n')
+        self.assertFalse(os.path.exists(MBOX_FP + '.lock'))
+
+        # an error already leaving the block is not replaced by git's
+        set_aside(REPO_FP)
+        with self.assertRaises(KeyError):
+            with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
+                self.init_from_template(instance)
+                instance.import_stream().stdin.write(b'not a fast-import command\n')
+                raise KeyError('from the with block')
+        self.assertFalse(os.path.exists(MBOX_FP + '.lock'))
+        with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
+            pass
+
+    def test_sync_repo_reports_reset_failure(self):
+        with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
+            self.init_from_template(instance)
+            subject, files_produced = instance.process_email(self.messages[0])
+            instance.make_commit(subject, files_produced)
+            # a leftover index.lock makes the reset after the import fail
+            lock_fp = os.path.join(REPO_FP, '.git', 'index.lock')
+            open(lock_fp, 'x').close()
+            with self.assertRaises(RuntimeError):
+                instance.sync_repo()
+            os.unlink(lock_fp)
+
     def test_identifies_correct_message_count(self):
         with mbox_to_git(MBOX_FP) as instance:
             self.assertEqual(len(instance.messages), 4)
 
+    def test_iter_raw_messages(self):
+        with mbox_to_git(MBOX_FP) as instance:
+            raw_messages = list(instance.iter_raw_messages())
+            self.assertEqual(len(raw_messages), 4)
+            for key, raw in zip(instance.mailbox.keys(), raw_messages):
+                self.assertEqual(raw, instance.mailbox.get_bytes(key))
+
+    def test_mmap_mbox_toc(self):
+        for fp in (MBOX_FP, TORTURE_FP):
+            expected, actual = mailbox.mbox(fp), mmap_mbox(fp)
+            expected._generate_toc()
+            actual._generate_toc()
+            self.assertEqual(actual._toc, expected._toc)
+            self.assertEqual(actual._file_length, expected._file_length)
+            expected.close()
+            actual.close()
+
+    def test_mmap_mbox_toc_reuse(self):
+        shutil.copyfile(MBOX_FP, THROWAWAY_FP)
+        first = mmap_mbox(THROWAWAY_FP)
+        self.assertEqual(len(first), 4)
+        first.close()
+
+        # an unchanged file gives the same table; a changed one is rescanned
+        second = mmap_mbox(THROWAWAY_FP)
+        self.assertEqual(len(second), 4)
+        second.close()
+        with open(THROWAWAY_FP, 'ab') as fh:
+            fh.write(b'\nFrom nobody  Thu Jul 30 18:52:06 2020\nSubject: added\n\nhi\n')
+        third = mmap_mbox(THROWAWAY_FP)
+        self.assertEqual(len(third), 5)
+        self.assertEqual(third[4]['subject'], 'added')
+        third.close()
+
+        # rewritten in place to the same size, then given its old mtime
+        # back: only the ctime tells, which utime moves until it does
+        st = os.stat(THROWAWAY_FP)
+        with open(THROWAWAY_FP, 'r+b') as fh:
+            content = fh.read()
+            fh.seek(0)
+            fh.write(content.replace(b'\nFrom nobody', b'\nXrom nobody'))
+        os.utime(THROWAWAY_FP, ns=(st.st_atime_ns, st.st_mtime_ns))
+        while os.stat(THROWAWAY_FP).st_ctime_ns == st.st_ctime_ns:
+            os.utime(THROWAWAY_FP, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertEqual(os.stat(THROWAWAY_FP).st_mtime_ns, st.st_mtime_ns)
+        fourth = mmap_mbox(THROWAWAY_FP)
+        self.assertEqual(len(fourth), 4)
+        fourth.close()
+        os.unlink(THROWAWAY_FP)
+
+        # each path has its own entry, and only the latest few are kept
+        for idx in range(MBOX_TOC_CACHE_SIZE + 1):
+            copy = mmap_mbox(shutil.copy(MBOX_FP, os.path.join(REPO_ROOT, 'toc%i' % idx)))
+            self.assertEqual(len(copy), 4)
+            copy.close()
+        self.assertEqual(len(MBOX_TOC_CACHE), MBOX_TOC_CACHE_SIZE)
+        self.assertNotIn(os.path.join(REPO_ROOT, 'toc0'), [key[0] for key in MBOX_TOC_CACHE])
+
+    def test_iter_messages(self):
+        with mbox_to_git(MBOX_FP) as instance:
+            for parsed, msg in zip(instance.iter_messages(), instance.messages):
+                self.assertEqual(parsed.as_bytes(), msg.as_bytes())
+            self.assertEqual(len(list(instance.iter_messages())), 4)
+
+    def test_iter_headers(self):
+        with mbox_to_git(MBOX_FP) as instance:
+            subjects = [h['subject'] for h in instance.iter_headers()]
+            self.assertEqual(subjects, [m['subject'] for m in instance.messages])
+
     def test_create_gitrepo_dir(self):
+        # the default ./mboxrepo is made from inside this run's REPO_ROOT,
+        # so concurrent runs of this suite never share it
+        cwd = os.getcwd()
+        os.chdir(REPO_ROOT)
+        try:
+            self.assertFalse(os.path.exists('mboxrepo'))
+            with mbox_to_git(MBOX_FP) as instance:
+                instance.init_repo()
+                self.assertEqual(instance.repodir, 'mboxrepo')
+            self.assertTrue(os.path.exists('mboxrepo'))
+            self.assertTrue(os.path.exists(REPO_FP))
+            set_aside('mboxrepo')
+        finally:
+            os.chdir(cwd)
+
         self.assertFalse(os.path.exists(REPO_FP))
-        with mbox_to_git(MBOX_FP) as instance:
+        with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
             instance.init_repo()
             self.assertEqual(instance.repodir, REPO_FP)
         self.assertTrue(os.path.exists(REPO_FP))
-        shutil.rmtree(REPO_FP)
-
-        self.assertFalse(os.path.exists('mboxrepo'))
-        with mbox_to_git(MBOX_FP, repodir='mboxrepo') as instance:
-            instance.init_repo()
-            self.assertEqual(instance.repodir, 'mboxrepo')
-        self.assertTrue(os.path.exists('mboxrepo'))
-        shutil.rmtree('mboxrepo')
+        set_aside(REPO_FP)
 
-        self.assertFalse(os.path.exists('mboxrepo2'))
-        with mbox_to_git(MBOX_FP, repodir='mboxrepo2') as instance:
+        other_repo = os.path.join(REPO_ROOT, 'mboxrepo2')
+        self.assertFalse(os.path.exists(other_repo))
+        with mbox_to_git(MBOX_FP, repodir=other_repo) as instance:
             instance.init_repo()
-            self.assertEqual(instance.repodir, 'mboxrepo2')
-        self.assertTrue(os.path.exists('mboxrepo2'))
-        shutil.rmtree('mboxrepo2')
+            self.assertEqual(instance.repodir, other_repo)
+        self.assertTrue(os.path.exists(other_repo))
+        set_aside(other_repo)
 
     def test_init_git_repo(self):
-        with mbox_to_git(MBOX_FP) as instance:
+        with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
             self.assertEqual(instance.commit_count, 0)
             instance.init_repo()
             self.assertTrue(os.path.exists(os.path.join(instance.repodir, '.git')))
             self.assertEqual(instance.commit_count, 0)
             self.assertTrue(instance.clean)
 
-    def test_create_mkstemp(self):
-        with mbox_to_git(MBOX_FP) as instance:
-            instance.init_repo()
-            subject, files_produced = instance.process_email(instance.messages[0])
-            self.assertEqual(len(files_produced), 1) #just body
-
-            fn_on_disk, fn_in_summary, fsize = files_produced[0]
-            self.assertTrue(os.path.isfile(fn_on_disk))
-            self.assertEqual(fn_in_summary, 'body')
-            os.unlink(fn_on_disk)
-
-            subject, files_produced = instance.process_email(instance.messages[1])
-            self.assertEqual(len(files_produced), 2) #body and attachment
+    def test_set_user_keeps_rest_of_config(self):
+        config_fp = os.path.join(REPO_FP, '.git', 'config')
+
+        def git_config(*args):
+            return subprocess.run(['git', 'config'] + list(args), cwd=REPO_FP,
+                                  stdout=subprocess.PIPE, text=True).stdout
+
+        with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
+            self.init_from_template(instance)
+            with open(config_fp, 'a') as fh:
+                fh.write('# kept as written\n'
+                         '[remote "origin"]\n'
+                         '\turl = /elsewhere\n'
+                         '\tfetch = +refs/heads/main:refs/remotes/origin/main\n'
+                         '\tfetch = +refs/tags/*:refs/tags/*\n'
+                         '[user] name = on the header line\n'
+                         '[user "sub"]\n'
+                         '\tname = subsection\n')
+
+            instance.set_user('will\n"bear" \\ home', 'will@bear.home')
+            self.assertEqual(git_config('--get-all', 'remote.origin.fetch').splitlines(),
+                             ['+refs/heads/main:refs/remotes/origin/main', '+refs/tags/*:refs/tags/*'])
+            self.assertEqual(git_config('--get-all', 'user.name'), 'will\n"bear" \\ home\n')
+            self.assertEqual(git_config('--get-all', 'user.email'), 'will@bear.home\n')
+            self.assertEqual(git_config('--get', 'user.sub.name'), 'subsection\n')
+            with open(config_fp) as fh:
+                self.assertIn('# kept as written\n', fh.read())
+
+            # a stale lock is an error, not something to skip over
+            open(config_fp + '.lock', 'x').close()
+            with self.assertRaises(RuntimeError):
+                instance.set_user('will', 'will@bear.home')
+            os.unlink(config_fp + '.lock')
+
+    # (name, size) of the parts written for each of the first sample messages
+    MESSAGE_PARTS = [ [('body', 34)],
+                      [('body', 23), ('rsakey.pub', 563)],
+                      [('body', 3), ('SCP_Foundation.png', 7716)] ]
+
+    def check_message_flow(self, indices, commit=True):
+        """ one repo, the messages at indices processed in turn: the parts
+            written (mkstemp file, name, size) are checked, then either
+            committed or unlinked again before the next message """
+        with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
+            self.init_from_template(instance)
+            self.assertIsNone(instance.head_id)
 
-            fn_on_disk, fn_in_summary, fsize = files_produced[0]
-            self.assertTrue(os.path.isfile(fn_on_disk))
-            self.assertEqual(fn_in_summary, 'body')
+            for count, idx in enumerate(indices):
+                with self.subTest(message=idx):
+                    self.assertTrue(instance.clean)
+                    subject, files_produced = instance.process_email(self.messages[idx])
+                    self.assertFalse(instance.clean)
+                    parts = self.MESSAGE_PARTS[idx]
+                    self.assertEqual(len(files_produced), len(parts))
+                    for (fn_on_disk, fn_in_summary, fsize), (name, size) in zip(files_produced, parts):
+                        self.assertTrue(os.path.isfile(fn_on_disk))
+                        self.assertEqual(fn_in_summary, name)
+                        self.assertEqual(os.path.getsize(fn_on_disk), size)
+                        self.assertEqual(fsize, size)
+
+                    if commit:
+                        self.assertEqual(instance.commit_count, count)
+                        short_commit = instance.make_commit(subject, files_produced)
+                        self.assertIsInstance(short_commit, str)
+                        self.assertTrue(len(short_commit) == 40)
+                        self.assertEqual(instance.head_id, short_commit)
+                        self.assertEqual(instance.commit_count, count + 1)
+                    else:
+                        for fn_on_disk, _, _ in files_produced:
+                            os.unlink(fn_on_disk)
+                        self.assertEqual(instance.commit_count, 0)
+                    self.assertTrue(instance.clean)
+
+    def test_per_message_flow(self):
+        self.check_message_flow([0, 1, 2])
 
-            fn_on_disk, fn_in_summary, fsize = files_produced[1]
-            self.assertTrue(os.path.isfile(fn_on_disk))
-            self.assertEqual(fn_in_summary, 'rsakey.pub')
+    def test_create_mkstemp(self):
+        self.check_message_flow([0, 1], commit=False)
 
     def test_fill_mkstemp(self):
-        with mbox_to_git(MBOX_FP) as instance:
-            instance.init_repo()
-            subject, files_produced = instance.process_email(instance.messages[0])
+        self.check_message_flow([1, 0], commit=False)
 
-            fn_on_disk, fn_in_summary, fsize = files_produced[0]
-            self.assertEqual(os.path.getsize(fn_on_disk), 34)
-            self.assertEqual(os.path.getsize(fn_on_disk), fsize)
-            os.unlink(fn_on_disk)
-
-            subject, files_produced = instance.process_email(instance.messages[1])
+    def test_fill_binary_attachment(self):
+        self.check_message_flow([2], commit=False)
 
-            fn_on_disk, fn_in_summary, fsize = files_produced[0]
-            self.assertEqual(os.path.getsize(fn_on_disk), 23)
-            self.assertEqual(os.path.getsize(fn_on_disk), fsize)
+    def test_make_commit(self):
+        self.check_message_flow([0])
 
-            fn_on_disk, fn_in_summary, fsize = files_produced[1]
-            self.assertEqual(os.path.getsize(fn_on_disk), 563)
-            self.assertEqual(os.path.getsize(fn_on_disk), fsize)
+    def test_get_git_head_commit(self):
+        self.check_message_flow([0, 1])
 
-    def test_fill_binary_attachment(self):
-        with mbox_to_git(MBOX_FP) as instance:
-            instance.init_repo()
-            subject, files_produced = instance.process_email(instance.messages[2])
+    def test_tree_clean(self):
+        self.check_message_flow([2, 0])
+
+    def test_adopt_parts_from_worker(self):
+        with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
+            self.init_from_template(instance)
+            raw_email = list(instance.iter_raw_messages())[1]
+            staging = tempfile.mkdtemp(dir=os.path.join(REPO_FP, '.git'))
+            subject, staged_parts = extract_raw_email(raw_email, staging)
+            self.assertTrue(instance.clean)
 
-            fn_on_disk, fn_in_summary, fsize = files_produced[0]
-            self.assertEqual(os.path.getsize(fn_on_disk), 3)
-            self.assertEqual(os.path.getsize(fn_on_disk), fsize)
+            files_produced = instance.adopt_parts(staged_parts)
+            self.assertEqual(os.listdir(staging), [])
+            self.assertEqual([(fn, size) for _, fn, size in files_produced],
+                             [('body', 23), ('rsakey.pub', 563)])
+            for fn_on_disk, _, fsize in files_produced:
+                self.assertEqual(os.path.dirname(fn_on_disk), os.path.abspath(REPO_FP))
+                self.assertEqual(os.path.getsize(fn_on_disk), fsize)
 
-            fn_on_disk, fn_in_summary, fsize = files_produced[1]
-            self.assertEqual(os.path.getsize(fn_on_disk), 7716)
-            self.assertEqual(os.path.getsize(fn_on_disk), fsize)
+            instance.make_commit(subject, files_produced)
+            self.assertEqual(instance.commit_count, 1)
+            shutil.rmtree(staging)
 
     def test_set_git_user(self):
-        import configparser
-        config = configparser.ConfigParser()
+        config_fp = os.path.join(REPO_FP, '.git', 'config')
 
-        with mbox_to_git(MBOX_FP) as instance:
-            from getpass import getuser
+        def read_user():
+            # only the two keys of the [user] section are wanted
+            with open(config_fp) as fh:
+                section = fh.read().partition('[user]')[2].partition('[')[0]
+            user = dict(USER_KEY.findall(section))
+            return (user['name'], user['email'])
+
+        with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
             instance.init_repo()
-            config.read(os.path.join(REPO_FP, '.git', 'config'))
-            self.assertEqual(config['user']['name'], getuser())
-            self.assertEqual(config['user']['email'], "%s@local" % getuser())
+            self.assertEqual(read_user(), (getuser(), "%s@local" % getuser()))
 
             instance.set_user('will', 'will@bear.home')
-            config.read(os.path.join(REPO_FP, '.git', 'config'))
-            self.assertEqual(config['user']['name'], 'will')
-            self.assertEqual(config['user']['email'], 'will@bear.home')
-
-    def test_make_commit(self):
-        with mbox_to_git(MBOX_FP) as instance:
-            instance.init_repo()
-            self.assertTrue(instance.clean)
-            subject, files_produced = instance.process_email(instance.messages[0])
-            self.assertEqual(instance.commit_count, 0)
-            short_commit = instance.make_commit(subject, files_produced)
-            self.assertTrue(len(short_commit) == 40)
-            self.assertIsInstance(short_commit, str)
-            self.assertEqual(instance.commit_count, 1)
-            self.assertTrue(instance.clean)
+            self.assertEqual(read_user(), ('will', 'will@bear.home'))
 
     def test_init_repo_graceful_reuse(self):
-        with mbox_to_git(MBOX_FP) as instance:
+        with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
             instance.init_repo()
             with self.assertRaises(FileExistsError):
                 instance.init_repo()
@@ -172,21 +393,46 @@ class Testmbox_to_git(unittest.TestCase):
             with self.assertRaises(FileExistsError):
                 instance.init_repo(encrypted=True)
 
-    def test_get_git_head_commit(self):
-        with mbox_to_git(MBOX_FP) as instance:
-            instance.init_repo()
-            subject, files_produced = instance.process_email(instance.messages[0])
-            self.assertIsNone(instance.head_id)
+    def test_forget_head_after_outside_commit(self):
+        with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
+            self.init_from_template(instance)
+            subject, files_produced = instance.process_email(self.messages[0])
+            commit = instance.make_commit(subject, files_produced)
+            self.assertEqual(instance.commit_count, 1)
+            subprocess.run(['git', 'commit', '--quiet', '--allow-empty', '-m', 'outside'],
+                           cwd=REPO_FP, check=True)
+
+            # remembered until told otherwise
+            self.assertEqual(instance.head_id, commit)
+            self.assertEqual(instance.commit_count, 1)
+            instance.forget_head()
+            self.assertNotEqual(instance.head_id, commit)
+            self.assertEqual(instance.commit_count, 2)
+
+    def test_commit_reads_parts_from_disk(self):
+        with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
+            self.init_from_template(instance)
+            subject, files_produced = instance.process_email(self.messages[1])
+            body_fp, attachment_fp = files_produced[0][0], files_produced[1][0]
+            with open(body_fp, 'wb') as fh:
+                fh.write(b'changed before the commit\n')
             instance.make_commit(subject, files_produced)
-            head_commit = instance.head_id
-            self.assertTrue(len(head_commit) == 40)
-            self.assertIsInstance(head_commit, str)
+            instance.sync_repo()
+            committed = subprocess.run(['git', 'show', 'HEAD:' + os.path.basename(body_fp)],
+                                       cwd=REPO_FP, stdout=subprocess.PIPE).stdout
+            self.assertEqual(committed, b'changed before the commit\n')
+
+            # a part removed before its commit is an error, not left out
+            subject, files_produced = instance.process_email(self.messages[0])
+            os.unlink(files_produced[0][0])
+            with self.assertRaises(FileNotFoundError):
+                instance.make_commit(subject, files_produced)
 
     def test_get_commit_by_stored_filename(self):
-        with mbox_to_git(MBOX_FP) as instance:
-            instance.init_repo()
+        with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
+            self.init_from_template(instance)
 
-            subject, files_produced = instance.process_email(instance.messages[1])
+            subject, files_produced = instance.process_email(self.messages[1])
             created_commit = instance.make_commit(subject, files_produced)
             
             rnd_name, orig_name, _ = files_produced[1]
@@ -197,11 +443,27 @@ class Testmbox_to_git(unittest.TestCase):
             self.assertIsInstance(matching_commit, str)
             self.assertEqual(matching_commit, created_commit)
 
+    def test_get_commits_of_files(self):
+        with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
+            self.init_from_template(instance)
+
+            rnd_names = []
+            for e in self.messages[:2]:
+                subject, files_produced = instance.process_email(e)
+                instance.make_commit(subject, files_produced)
+                rnd_names.extend(os.path.basename(rnd) for rnd, _, _ in files_produced)
+
+            matching_commits = instance.get_commits_of_files(rnd_names + ['notafile'])
+            self.assertEqual(set(matching_commits), set(rnd_names))
+            for rnd_name in rnd_names:
+                self.assertEqual(matching_commits[rnd_name], instance.get_commit_of_file(rnd_name))
+            self.assertNotEqual(matching_commits[rnd_names[0]], matching_commits[rnd_names[1]])
+
     def test_get_commit_filelist(self):
-        with mbox_to_git(MBOX_FP) as instance:
-            instance.init_repo()
+        with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
+            self.init_from_template(instance)
 
-            subject, files_produced = instance.process_email(instance.messages[1])
+            subject, files_produced = instance.process_email(self.messages[1])
             commit = instance.make_commit(subject, files_produced)
             
             rnd_name, orig_name, _ = files_produced[0]
@@ -211,8 +473,25 @@ class Testmbox_to_git(unittest.TestCase):
             self.assertTrue(rnd_name in file_list)
             self.assertEqual(len(file_list), 2)
 
+    def test_history_queries_follow_head(self):
+        with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
+            self.init_from_template(instance)
+            subject, files_produced = instance.process_email(self.messages[0])
+            instance.make_commit(subject, files_produced)
+
+            # asked before the file is committed, and again after
+            subject, files_produced = instance.process_email(self.messages[1])
+            rnd_name = os.path.basename(files_produced[0][0])
+            self.assertEqual(instance.get_commit_of_file(rnd_name), '')
+            commit = instance.make_commit(subject, files_produced)
+            self.assertEqual(instance.get_commit_of_file(rnd_name), commit)
+            self.assertIn(rnd_name, instance.get_commit_filelist('HEAD'))
+            # only answers for the current HEAD are held
+            self.assertEqual(set(instance.query_cache),
+                             {('commit_of_file', rnd_name), ('commit_filelist', 'HEAD')})
+
     def test_init_secret(self):
-        with mbox_to_git(MBOX_FP) as instance:
+        with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
             self.assertEqual(instance.commit_count, 0)
             instance.init_repo(encrypted=True)
             self.assertTrue(os.path.exists(os.path.join(instance.repodir, '.gitsecret')))
@@ -220,9 +499,9 @@ class Testmbox_to_git(unittest.TestCase):
             self.assertTrue(instance.clean)
 
     def test_tell_secret(self):
-        with mbox_to_git(MBOX_FP) as instance:
+        with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
             self.assertEqual(instance.commit_count, 0)
-            instance.init_repo(encrypted=True)
+            self.init_from_template(instance, encrypted=True)
             self.assertEqual(instance.commit_count, 1)
             instance.tell_secret(GPG_EMAIL)
             self.assertEqual(instance.commit_count, 2)
@@ -230,14 +509,26 @@ class Testmbox_to_git(unittest.TestCase):
             self.assertTrue(os.path.isfile(os.path.join(gitsecret_path, 'keys', 'pubring.kbx')))
             self.assertTrue(os.path.isfile(os.path.join(gitsecret_path, 'keys', 'trustdb.gpg')))
 
+    def test_tell_secret_after_commit(self):
+        with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
+            self.init_from_template(instance, encrypted=True)
+            subject, files_produced = instance.process_email(self.messages[0])
+            commit = instance.make_commit(subject, files_produced)
+            # the commit is still in the fast-import stream at this point
+            instance.tell_secret(GPG_EMAIL)
+            self.assertEqual(instance.commit_count, 3)
+            self.assertEqual(instance.get_commit_of_file(os.path.basename(files_produced[0][0])), commit)
+        with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
+            self.assertEqual(instance.commit_count, 3)
+
     def test_make_secret(self):
-        with mbox_to_git(MBOX_FP) as instance:
+        with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
             self.assertEqual(instance.commit_count, 0)
-            instance.init_repo(encrypted=True)
+            self.init_from_template(instance, encrypted=True)
             instance.tell_secret(GPG_EMAIL)
             self.assertTrue(instance.clean)
 
-            subject, files_produced = instance.process_email(instance.messages[0])
+            subject, files_produced = instance.process_email(self.messages[0])
             commit_count = instance.commit_count
             short_commit = instance.make_secret_commit(subject, files_produced)
             self.assertEqual(instance.commit_count, commit_count + 1)
@@ -246,21 +537,43 @@ class Testmbox_to_git(unittest.TestCase):
             self.assertFalse(os.path.isfile(os.path.join(instance.repodir, filename)))
             self.assertTrue(instance.clean)
 
-    def test_tree_clean(self):
-        with mbox_to_git(MBOX_FP) as instance:
-            instance.init_repo()
+    def test_verify_clean(self):
+        for verify_clean in (False, True):
+            set_aside(REPO_FP)
+            with mbox_to_git(MBOX_FP, repodir=REPO_FP, verify_clean=verify_clean) as instance:
+                self.init_from_template(instance)
+                subject, files_produced = instance.process_email(self.messages[0])
+                instance.make_commit(subject, files_produced)
+                os.unlink(files_produced[0][0]) # removed behind the tracker's back
+                self.assertEqual(instance.clean, not verify_clean)
+                self.assertFalse(instance.is_clean(force_refresh=True))
+
+    def test_clean_checks_keep_import_stream(self):
+        with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
+            self.init_from_template(instance)
+            subject, files_produced = instance.process_email(self.messages[0])
+            instance.make_commit(subject, files_produced)
+            importer = instance.importer
 
-            self.assertTrue(instance.clean)
-            subject, files_produced = instance.process_email(instance.messages[0])
+            # pending parts, then the same parts removed: neither check syncs
+            subject, files_produced = instance.process_email(self.messages[1])
             self.assertFalse(instance.clean)
-            commit = instance.make_commit(subject, files_produced)
+            for fn_on_disk, _, _ in files_produced:
+                os.unlink(fn_on_disk)
             self.assertTrue(instance.clean)
 
+            subject, files_produced = instance.process_email(self.messages[2])
+            instance.make_commit(subject, files_produced[:1])
+            self.assertFalse(instance.clean) # one part left uncommitted
+            self.assertIs(instance.importer, importer)
+            self.assertFalse(instance.is_clean(force_refresh=True))
+            self.assertIsNone(instance.importer)
+
     def test_create_tarball(self):
-        with mbox_to_git(MBOX_FP) as instance:
-            instance.init_repo()
+        with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
+            self.init_from_template(instance)
 
-            for e in instance.messages:
+            for e in self.messages:
                 subject, files_produced = instance.process_email(e)
                 commit = instance.make_commit(subject, files_produced)
 
@@ -269,24 +582,38 @@ class Testmbox_to_git(unittest.TestCase):
                 for rnd, orig, _ in files_produced:
                     renames[orig] = os.path.basename(rnd)
 
-                file_created = instance.create_tarball()
+                file_created = instance.create_tarball(TARBALL_FP)
                 self.assertTrue(os.path.isfile(file_created))
+                # built from the summary, so the import stream stays open
+                self.assertIsNotNone(instance.importer)
 
-                import tarfile
-
-                self.assertTrue(tarfile.is_tarfile(file_created))
+                self.assertTrue(is_ustar(file_created))
                 with tarfile.TarFile(file_created, 'r') as tf:
-                    self.assertEqual(set(tf.getnames()), set(src_filenames))
-                    for m in tf.getmembers():
-                        file_on_disk = os.path.join(instance.repodir, renames[m.name])
-                        self.assertEqual(m.size, os.stat(file_on_disk).st_size)
+                    members = tf.getmembers()
+                self.assertEqual({m.name for m in members}, set(src_filenames))
+                for m in members:
+                    file_on_disk = os.path.join(instance.repodir, renames[m.name])
+                    self.assertEqual(m.size, os.stat(file_on_disk).st_size)
+
+    def test_create_tarball_from_git(self):
+        with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
+            self.init_from_template(instance)
+            subject, files_produced = instance.process_email(self.messages[2])
+            instance.make_commit(subject, files_produced)
+            with tarfile.open(instance.create_tarball(TARBALL_FP)) as tf:
+                from_summary = [(m.name, m.size) for m in tf.getmembers()]
+
+        # a new object did not make HEAD, so the mapping comes from git show
+        with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
+            with tarfile.open(instance.create_tarball(TARBALL_FP)) as tf:
+                self.assertEqual([(m.name, m.size) for m in tf.getmembers()], from_summary)
 
     def test_create_tarball_encrypted(self):
-        with mbox_to_git(MBOX_FP) as instance:
-            instance.init_repo(encrypted=True)
+        with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
+            self.init_from_template(instance, encrypted=True)
             instance.tell_secret(GPG_EMAIL)
 
-            for e in instance.messages:
+            for e in self.messages:
                 subject, files_produced = instance.process_email(e)
                 commit = instance.make_secret_commit(subject, files_produced)
 
@@ -295,39 +622,39 @@ class Testmbox_to_git(unittest.TestCase):
                 for rnd, orig, _ in files_produced:
                     renames[orig] = os.path.basename(rnd) + '.secret'
 
-                file_created = instance.create_tarball()
+                file_created = instance.create_tarball(TARBALL_FP)
                 self.assertTrue(os.path.isfile(file_created))
 
-                import tarfile
-
-                self.assertTrue(tarfile.is_tarfile(file_created))
-                with tarfile.TarFile(file_created, 'r') as tf:
-                    self.assertEqual(set(tf.getnames()), set(src_filenames))
-                    for m in tf.getmembers():
-                        file_on_disk = os.path.join(instance.repodir, renames[m.name])
-                        self.assertEqual(m.size, os.stat(file_on_disk).st_size)
+                self.assertTrue(is_ustar(file_created))
+                # read front to back as a stream, never seeking
+                with tarfile.open(file_created, 'r|') as tf:
+                    members = list(tf)
+                self.assertEqual({m.name for m in members}, set(src_filenames))
+                for m in members:
+                    file_on_disk = os.path.join(instance.repodir, renames[m.name])
+                    self.assertEqual(m.size, os.stat(file_on_disk).st_size)
                 os.unlink(file_created)
 
     def test_decorator_check_clean_before(self):
-        with mbox_to_git(MBOX_FP) as instance:
-            instance.init_repo()
+        with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
+            self.init_from_template(instance)
 
             try:
-                subject, files_produced = instance.process_email(instance.messages[0])
+                subject, files_produced = instance.process_email(self.messages[0])
             except ExceptionType:
                 self.fail("this should not have thrown anything")
 
             with self.assertRaises(RuntimeError):
-                subject, files_produced = instance.process_email(instance.messages[0])
+                subject, files_produced = instance.process_email(self.messages[0])
 
     def test_decorator_check_clean_after(self):
-        with mbox_to_git(MBOX_FP) as instance:
-            instance.init_repo()
+        with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
+            self.init_from_template(instance)
 
-            subject, files_produced = instance.process_email(instance.messages[0])
+            subject, files_produced = instance.process_email(self.messages[0])
 
             with self.assertRaises(RuntimeError):
-                subject, files_produced = instance.process_email(instance.messages[0])
+                subject, files_produced = instance.process_email(self.messages[0])
 
             try:
                 commit = instance.make_commit(subject, files_produced)
@@ -335,18 +662,38 @@ class Testmbox_to_git(unittest.TestCase):
                 self.fail("this should not have thrown anything")
 
     def test_inbound_utf_encoding(self):
-        with mbox_to_git(MBOX_FP) as instance:
-            instance.init_repo()
-            subject, files_produced = instance.process_email(instance.messages[3])
+        with mbox_to_git(MBOX_FP, repodir=REPO_FP) as instance:
+            self.init_from_template(instance)
+            subject, files_produced = instance.process_email(self.messages[3])
+            short_commit = instance.make_commit(subject, files_produced)
+
+    def test_inbound_8bit_content(self):
+        newfile = THROWAWAY_FP
+        with open(newfile, 'wb') as fh:
+            fh.write(b'From will@raspberrypi.bear.home  Thu Jul 30 18:52:06 2020\n'
+                     b'Subject: caf\xe9\n'
+                     b'Content-Type: text/plain; charset=latin-1\n'
+                     b'Content-Transfer-Encoding: 8bit\n'
+                     b'\n'
+                     b'd\xe9j\xe0 vu\n')
+
+        with mbox_to_git(newfile, repodir=REPO_FP) as instance:
+            self.init_from_template(instance)
+            subject, files_produced = instance.process_email(instance.messages[0])
+            fn_on_disk, fn_in_summary, fsize = files_produced[0]
+            with open(fn_on_disk, 'rb') as fh:
+                self.assertEqual(fh.read(), b'd\xe9j\xe0 vu\n')
+            self.assertEqual(fsize, 8)
             short_commit = instance.make_commit(subject, files_produced)
+            self.assertTrue(len(short_commit) == 40)
+        os.unlink(newfile)
 
     def test_empty_mbox_after_processing(self):
-        from shutil import copyfile
-        newfile = 'mbox.throwaway'
-        copyfile(MBOX_FP, newfile)
+        newfile = THROWAWAY_FP
+        shutil.copyfile(MBOX_FP, newfile)
 
-        with mbox_to_git(newfile) as instance:
-            instance.init_repo()
+        with mbox_to_git(newfile, repodir=REPO_FP) as instance:
+            self.init_from_template(instance)
 
             mbox_size = os.stat(newfile).st_size
             for e in instance.messages:
@@ -361,8 +708,8 @@ class Testmbox_to_git(unittest.TestCase):
         """ this mbox has many, many parts. it will produce 24 files,
             of which, 17 are body content emails.
         """
-        with mbox_to_git('rf-mime-torture-test-1.0.mbox') as instance:
-            instance.init_repo()
+        with mbox_to_git(TORTURE_FP, repodir=REPO_FP) as instance:
+            self.init_from_template(instance)
             for e in instance.messages:
                 subject, files_produced = instance.process_email(e)
                 commit = instance.make_commit(subject, files_produced)
@@ -372,23 +719,38 @@ class Testmbox_to_git(unittest.TestCase):
                 for rnd, orig, _ in files_produced:
                     renames[orig] = os.path.basename(rnd)
 
-                file_created = instance.create_tarball()
+                file_created = instance.create_tarball(TARBALL_FP)
                 self.assertTrue(os.path.isfile(file_created))
 
-                import tarfile
-
-                self.assertTrue(tarfile.is_tarfile(file_created))
+                self.assertTrue(is_ustar(file_created))
                 with tarfile.TarFile(file_created, 'r') as tf:
-                    self.assertEqual(set(tf.getnames()), set(src_filenames))
-                    self.assertEqual(len(tf.getmembers()), 24)
-                    count_bodies = 0
-                    count_actual_body = 0 #matching 'body' exactly
-                    for m in tf.getmembers():
-                        if m.name.startswith('body'): count_bodies += 1
-                        if m.name == ('body'): count_actual_body += 1
-                        file_on_disk = os.path.join(instance.repodir, renames[m.name])
-                    self.assertEqual(count_bodies, 17)
-                    self.assertEqual(count_actual_body, 1)
+                    members = tf.getmembers()
+                self.assertEqual({m.name for m in members}, set(src_filenames))
+                self.assertEqual(len(members), 24)
+                count_bodies = 0
+                count_actual_body = 0 #matching 'body' exactly
+                for m in members:
+                    if m.name.startswith('body'): count_bodies += 1
+                    if m.name == ('body'): count_actual_body += 1
+                    file_on_disk = os.path.join(instance.repodir, renames[m.name])
+                self.assertEqual(count_bodies, 17)
+                self.assertEqual(count_actual_body, 1)
+
+    def test_decode_payload_matches_email(self):
+        # stdlib base64 stands in for pybase64, which shares its interface
+        torture = mailbox.mbox(TORTURE_FP)
+        parts = [p for msg in torture for p in msg.walk() if not p.is_multipart()]
+        torture.close()
+        # padding stdlib b64decode rejects; the email package repairs it
+        parts.append(message_from_bytes(b'Content-Transfer-Encoding: base64\n\nYWJj\nZA\n'))
+
+        with mock.patch('convert.pybase64', base64):
+            encoded = [p for p in parts
+                       if p.get('content-transfer-encoding', '').strip().lower() == 'base64']
+            self.assertGreater(len(encoded), 1)
+            for part in parts:
+                self.assertEqual(decode_payload(part), part.get_payload(decode=True))
+            self.assertEqual(decode_payload(parts[-1]), b'abcd')
 
 if __name__ == '__main__':
     unittest.main()